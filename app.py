@@ -1,13 +1,15 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import plotly.express as px
-import time
+import plotly.graph_objects as go
 import cv2
 from PIL import Image
-import tempfile
+import concurrent.futures
+import io
 import os
 
+from utils import omr_processor as omr
+
 # ============================================
 # 🎨 PAGE CONFIGURATION
 # ============================================
@@ -18,130 +20,164 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# ============================================
+# 🔧 IMAGE DECODE
+# ============================================
+# Fixed schema of the results table; declared once so DataFrame
+# construction and CSV export see stable dtypes.
+_RESULTS_DTYPE = np.dtype([
+    ("Student ID", "U8"),
+    ("Score (%)", "f8"),
+    ("AI Confidence (%)", "f8"),
+    ("Status", "U4"),
+])
+
+_REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+
+def bytes_to_cv2_image(data, reduce=1):
+    """Decode raw image bytes straight into a BGR array.
+
+    `reduce` selects libjpeg's DCT-domain downscale (1/2, 1/4, 1/8),
+    which is ~4x cheaper than a full decode followed by resize.
+    cv2.imdecode releases the GIL, so calls made concurrently (here, one
+    per process-pool worker) overlap instead of serializing on decode.
+    """
+    arr = np.frombuffer(data, dtype=np.uint8)
+    return cv2.imdecode(arr, _REDUCED_DECODE_FLAGS[reduce])
+
+
 # ============================================
 # 🔧 OMR DETECTION FUNCTION (PRODUCTION-GRADE)
 # ============================================
 def omr_detect_answers(uploaded_file, debug=False):
-    # Save uploaded file to temporary location
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
-        tmp.write(uploaded_file.getbuffer())
-        img_path = tmp.name
-
     try:
-        img = cv2.imread(img_path)
+        # Decode straight from the in-memory buffer — no temp-file round-trip
+        # and no PIL RGB conversion: raw bytes feed np.frombuffer zero-copy.
+        # PIL reads only the header here; half-size decode is safe whenever
+        # the result still exceeds the pipeline's working resolution.
+        data = (uploaded_file.getbuffer()
+                if hasattr(uploaded_file, "getbuffer") else uploaded_file)
+        with Image.open(io.BytesIO(data)) as header:
+            long_side = max(header.size)
+        img = bytes_to_cv2_image(
+            data, reduce=2 if long_side >= 2 * omr.WORKING_RES else 1
+        )
         if img is None:
             raise ValueError("Failed to load image. Check file integrity.")
 
-        orig = img.copy()
-
-        # --------- Auto Deskew ---------
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        gray = cv2.GaussianBlur(gray, (5, 5), 0)
-        edges = cv2.Canny(gray, 50, 150)
-        coords = np.column_stack(np.where(edges > 0))
-
-        if len(coords) > 0:
-            angle = cv2.minAreaRect(coords)[-1]
-            if angle < -45:
-                angle = -(90 + angle)
-            else:
-                angle = -angle
-            (h, w) = img.shape[:2]
-            M = cv2.getRotationMatrix2D((w // 2, h // 2), angle, 1.0)
-            img = cv2.warpAffine(img, M, (w, h),
-                                 flags=cv2.INTER_CUBIC,
-                                 borderMode=cv2.BORDER_REPLICATE)
-
-        # --------- Color-aware threshold ---------
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-        v = hsv[:, :, 2]
-
-        thresh = cv2.adaptiveThreshold(
-            v, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-            cv2.THRESH_BINARY_INV, 15, 3
-        )
-
-        kernel = np.ones((3, 3), np.uint8)
-        thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
-        thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
-
-        # --------- Bubble Detection ---------
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        bubbles = []
-        for c in contours:
-            area = cv2.contourArea(c)
-            if 60 < area < 3000:
-                x, y, w, h = cv2.boundingRect(c)
-                aspect_ratio = w / h
-                if 0.6 < aspect_ratio < 1.4:
-                    bubbles.append((x, y, w, h))
-
-        if not bubbles:
-            return {}
-
-        # --------- Smart Row Clustering ---------
-        bubbles = sorted(bubbles, key=lambda b: b[1])
-        rows = []
-        for b in bubbles:
-            placed = False
-            for row in rows:
-                if abs(row[0][1] - b[1]) < 20:
-                    row.append(b)
-                    placed = True
-                    break
-            if not placed:
-                rows.append([b])
-
-        for row in rows:
-            row.sort(key=lambda b: b[0])
-
-        # --------- Filled Bubble Detection ---------
-        answers = {}
-        for qi, row in enumerate(rows, start=1):
-            best_fill = 0
-            best_opt = None
-            for oi, (x, y, w, h) in enumerate(row):
-                roi = thresh[y:y+h, x:x+w]
-                fill = cv2.countNonZero(roi) / (w * h)
-
-                if debug:
-                    color = (0, 255, 0) if fill > 0.2 else (0, 0, 255)
-                    cv2.rectangle(orig, (x, y), (x + w, y + h), color, 2)
-
-                if fill > best_fill and fill > 0.2:
-                    best_fill = fill
-                    best_opt = chr(ord('A') + oi)
-
-            if best_opt:
-                answers[str(qi)] = best_opt
-
         if debug:
+            answers, overlay = omr.detect_answers(img, debug=True)
             st.subheader("🖼️ Debug Overlay")
-            st.image(cv2.cvtColor(orig, cv2.COLOR_BGR2RGB), use_container_width=True)
+            st.image(cv2.cvtColor(overlay, cv2.COLOR_BGR2RGB), use_container_width=True)
+            return answers
 
-        return answers
+        return omr.detect_answers(img)
 
     except Exception as e:
         st.warning(f"OMR Processing Error: {str(e)}")
         return {}
 
-    finally:
-        # Clean up temp file
-        if os.path.exists(img_path):
-            os.unlink(img_path)
+
+# ============================================
+# 🔧 PARALLEL WORKER
+# ============================================
+def _grade_sheet(sheet_bytes, key_answers):
+    """Process one student sheet in a worker process.
+
+    Only raw bytes and plain dicts cross the process boundary — never
+    cv2 images — so pickling stays cheap. Debug overlays are disabled
+    in workers for the same reason.
+    """
+    student_answers = omr_detect_answers(sheet_bytes, debug=False)
+    score = calculate_score(key_answers, student_answers)
+    return student_answers, score
+
+
+# ============================================
+# 🔧 CACHED DETECTION
+# ============================================
+@st.cache_data(show_spinner=False, max_entries=64)
+def _omr_from_bytes(sheet_bytes, debug=False):
+    """Cached OMR detection keyed on the raw image bytes.
+
+    Streamlit reruns the whole script on every widget interaction;
+    fingerprinting the bytes lets repeat runs skip detection entirely.
+    """
+    return omr_detect_answers(sheet_bytes, debug=debug)
+
+
+@st.cache_data(show_spinner=False)
+def _score_figures(df):
+    """Build both result charts once per distinct result set.
+
+    Binning happens server-side in NumPy rather than in the browser,
+    and the scatter uses WebGL so it stays smooth at large batch sizes.
+    """
+    counts, edges = np.histogram(df["Score (%)"], bins=10)
+    fig1 = go.Figure(go.Bar(x=(edges[:-1] + edges[1:]) / 2, y=counts))
+    fig1.update_layout(title="Score Distribution",
+                       xaxis_title="Score (%)", yaxis_title="Students")
+
+    fig2 = go.Figure(go.Scattergl(
+        x=df["Score (%)"], y=df["AI Confidence (%)"], mode="markers",
+        text=df["Student ID"], customdata=df["Status"],
+        hovertemplate=("Score: %{x}%<br>Confidence: %{y:.1f}%"
+                       "<br>%{text} (%{customdata})<extra></extra>"),
+    ))
+    fig2.update_layout(title="Score vs AI Confidence",
+                       xaxis_title="Score (%)", yaxis_title="Confidence (%)")
+    return fig1, fig2
+
+
+@st.cache_data(show_spinner=False)
+def _results_csv(df):
+    """Serialize the results table once per distinct result set.
+
+    Writing through a buffer with chunksize keeps the intermediate
+    formatting working set at one row block rather than the whole table.
+    """
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, chunksize=10_000)
+    return buf.getvalue()
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _grade_batch(papers_bytes, key_answers):
+    """Grade a batch of sheets in parallel, cached across reruns."""
+    with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        futures = [ex.submit(_grade_sheet, b, key_answers) for b in papers_bytes]
+        return [f.result() for f in futures]
 
 
 # ============================================
 # 🔧 SCORE CALCULATION
 # ============================================
+def _answers_to_array(answers, nq):
+    """Encode an answer dict as uint8 codes (0 = blank, 1..n = A..)."""
+    arr = np.zeros(nq, dtype=np.uint8)
+    for q, letter in answers.items():
+        qi = int(q) - 1
+        if 0 <= qi < nq:
+            arr[qi] = ord(letter) - ord('A') + 1
+    return arr
+
+
 def calculate_score(key_answers, student_answers):
     total = len(key_answers)
     if total == 0:
         return 0
-    correct = 0
-    for q in key_answers:
-        if q in student_answers and key_answers[q] == student_answers[q]:
-            correct += 1
+    # Grade as one vectorized compare on small-int arrays; the dicts
+    # stay around only for JSON display.
+    nq = max(int(q) for q in key_answers)
+    key_arr = _answers_to_array(key_answers, nq)
+    stu_arr = _answers_to_array(student_answers, nq)
+    correct = int(((key_arr == stu_arr) & (key_arr != 0)).sum())
     return round((correct / total) * 100, 2)
 
 
@@ -150,8 +186,12 @@ def calculate_score(key_answers, student_answers):
 # ============================================
 if "answer_key_image" not in st.session_state:
     st.session_state.answer_key_image = None
+if "answer_key_answers" not in st.session_state:
+    st.session_state.answer_key_answers = None
 if "student_papers" not in st.session_state:
     st.session_state.student_papers = []
+if "student_papers_bytes" not in st.session_state:
+    st.session_state.student_papers_bytes = []
 if "results" not in st.session_state:
     st.session_state.results = None
 
@@ -170,6 +210,8 @@ with st.sidebar:
 
     if answer_key_upload:
         st.session_state.answer_key_image = answer_key_upload
+        # Detect once at upload time; Start Comparison reuses the dict.
+        st.session_state.answer_key_answers = _omr_from_bytes(answer_key_upload.getvalue())
         st.image(answer_key_upload, caption="Answer Key", use_container_width=True)
 
     passing_score = st.slider("Passing Score (%)", 40, 100, 60, help="Minimum score required to pass")
@@ -190,8 +232,19 @@ student_uploads = st.file_uploader(
 
 if student_uploads:
     st.session_state.student_papers = student_uploads
+    st.session_state.student_papers_bytes = [f.getvalue() for f in student_uploads]
     st.success(f"✅ Uploaded {len(student_uploads)} answer sheets successfully.")
 
+    # Ship small thumbnails to the browser, not N full-resolution photos
+    # on every rerun. PIL's thumbnail() uses the cheap JPEG draft decode.
+    with st.expander("🖼️ Sheet Previews"):
+        thumbs = []
+        for f in student_uploads:
+            im = Image.open(f)
+            im.thumbnail((120, 120))
+            thumbs.append(im)
+        st.image(thumbs, width=120)
+
 
 # ============================================
 # 🔬 START COMPARISON
@@ -202,15 +255,16 @@ if st.button("🔬 Start Comparison", use_container_width=True):
         st.error("❌ Please upload an answer key image first.")
         st.stop()
 
-    if not st.session_state.student_papers:
+    if not st.session_state.student_papers_bytes:
         st.error("❌ Please upload at least one student answer sheet.")
         st.stop()
 
     with st.spinner("🔍 Processing OMR sheets..."):
-        time.sleep(0.5)  # Simulate processing delay
-
-        # Detect answers from answer key
-        key_answers = omr_detect_answers(st.session_state.answer_key_image, debug=False)
+        # Answer key was detected at upload time; fall back to the cached
+        # detector for sessions created before the key handler ran.
+        key_answers = st.session_state.answer_key_answers
+        if key_answers is None:
+            key_answers = _omr_from_bytes(st.session_state.answer_key_image.getvalue())
         st.subheader("🔍 Answer Key OMR Detection Results")
         if key_answers:
             st.json(key_answers)
@@ -218,34 +272,53 @@ if st.button("🔬 Start Comparison", use_container_width=True):
             st.warning("No valid bubbles detected in the answer key.")
 
         results = []
+        detections = {}
+
+        # Each sheet is an independent CPU-bound OpenCV pipeline, so
+        # fan the batch out across processes; repeat clicks on the same
+        # uploads hit the cache and skip the pool entirely.
+        graded = _grade_batch(st.session_state.student_papers_bytes, key_answers)
+
+        # One RNG call for the whole batch instead of one per student.
+        confidences = np.random.uniform(85, 99, size=len(graded))
 
-        for i, paper in enumerate(st.session_state.student_papers):
+        for i, (student_answers, score) in enumerate(graded):
             try:
-                student_answers = omr_detect_answers(paper, debug=False)
-                score = calculate_score(key_answers, student_answers)
-                confidence = np.random.uniform(85, 99)
+                confidence = float(confidences[i])
 
                 status = "PASS" if score >= passing_score else "FAIL"
 
                 results.append({
                     "Student ID": f"STU{i+1:03d}",
                     "Score (%)": score,
-                    "AI Confidence (%)": f"{confidence:.1f}%",
+                    "AI Confidence (%)": confidence,
                     "Status": status
                 })
 
-                st.subheader(f"🧪 Student {i+1} OMR Detection Results")
-                if student_answers:
-                    st.json(student_answers)
-                else:
-                    st.warning("No valid bubbles detected.")
+                # Collected here and rendered once below — per-student
+                # widget calls are a browser round-trip each.
+                detections[f"Student {i+1}"] = (
+                    student_answers if student_answers else "No valid bubbles detected."
+                )
 
             except Exception as e:
                 st.error(f"Error processing student {i+1}: {e}")
                 continue
 
+        if detections:
+            with st.expander("🧪 Per-Student OMR Detections"):
+                st.json(detections)
+
         if results:
-            st.session_state.results = pd.DataFrame(results)
+            # Rows are accumulated as plain dicts and the DataFrame is
+            # built exactly once from a pre-declared record dtype, so
+            # pandas skips its per-column type-inference pass.
+            records = np.array(
+                [(r["Student ID"], r["Score (%)"], r["AI Confidence (%)"], r["Status"])
+                 for r in results],
+                dtype=_RESULTS_DTYPE,
+            )
+            st.session_state.results = pd.DataFrame.from_records(records)
             st.success(f"✅ Completed analysis for {len(results)} students.")
         else:
             st.warning("No valid results were generated.")
@@ -264,22 +337,24 @@ if st.session_state.results is not None:
     col2.metric("Pass Rate", f"{pass_rate:.1f}%")
     col3.metric("Top Score", f"{df['Score (%)'].max()}%")
 
-    # Data Table
-    st.dataframe(df, use_container_width=True)
+    # Data Table — confidence is stored as a float and only formatted
+    # here, so no per-rerun string parsing is ever needed.
+    st.dataframe(
+        df,
+        use_container_width=True,
+        column_config={
+            "AI Confidence (%)": st.column_config.NumberColumn(format="%.1f%%")
+        },
+    )
 
     # Visualizations
-    fig1 = px.histogram(df, x="Score (%)", nbins=10, title="Score Distribution")
+    fig1, fig2 = _score_figures(df)
     st.plotly_chart(fig1, use_container_width=True)
-
-    df["AI_Confidence_num"] = df["AI Confidence (%)"].str.rstrip('%').astype(float)
-    fig2 = px.scatter(df, x="Score (%)", y="AI_Confidence_num",
-                      title="Score vs AI Confidence",
-                      labels={"Score (%)": "Score (%)", "AI_Confidence_num": "Confidence (%)"},
-                      hover_data=["Student ID", "Status"])
     st.plotly_chart(fig2, use_container_width=True)
 
-    # Download Button
-    csv = df.to_csv(index=False)
+    # Download Button — CSV bytes are cached per result set, so the
+    # serialization cost is not re-paid on every widget interaction.
+    csv = _results_csv(df)
     st.download_button(
         label="📥 Download Results as CSV",
         data=csv,
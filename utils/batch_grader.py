@@ -0,0 +1,37 @@
+import functools
+import multiprocessing as mp
+
+import cv2
+import numpy as np
+
+from utils.omr_processor import detect_bubbles
+from utils.scorer import calculate_score
+
+
+def process_sheet(img, key):
+    """Grade one sheet (ndarray or encoded image bytes) against the key.
+
+    Top-level and picklable so it can run in pool workers; only bytes or
+    arrays plus the key dict ever cross the process boundary.
+    """
+    if isinstance(img, (bytes, bytearray, memoryview)):
+        # Decode straight to grayscale: detect_bubbles takes the 2D
+        # plane as-is, and a BGR decode would hit its RGB-order
+        # conversion with swapped channel weights.
+        img = cv2.imdecode(np.frombuffer(img, np.uint8), cv2.IMREAD_GRAYSCALE)
+    answers = detect_bubbles(img)
+    return calculate_score(key, answers)
+
+
+def grade_sheets(pages, key, chunksize=4):
+    """Grade an iterable of sheets across a process pool, yielding scores.
+
+    The full pipeline is independent per sheet, so workers scale nearly
+    linearly with cores. Pairs with the streaming
+    extract_images_from_pdf generator: pages flow into workers without
+    the whole document being materialized first. Scores arrive in
+    completion order.
+    """
+    worker = functools.partial(process_sheet, key=key)
+    with mp.Pool() as pool:
+        yield from pool.imap_unordered(worker, pages, chunksize)
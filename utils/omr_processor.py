@@ -1,73 +1,246 @@
 import cv2
 import numpy as np
-import pytesseract
+from numba import int8, int32, int64, njit
 from PIL import Image
 
-def detect_bubbles(image, debug=False):
+# Frozen pipeline thresholds, shared by every caller.
+WORKING_RES = 1000          # long-side working resolution, px
+MIN_BUBBLE_AREA = 60        # contour area bounds at working resolution
+MAX_BUBBLE_AREA = 3000
+BUBBLE_ROW_GAP = 20         # px gap that starts a new question row
+FILL_THRESHOLD = 0.2        # fraction of dark pixels that marks a bubble
+DESKEW_MIN_ANGLE = 0.3      # degrees; skip the warp below this
+
+# Constant 3x3 kernel shared by every sheet; getStructuringElement lets
+# OpenCV take its precomputed SIMD fast path for the common rect shape.
+_MORPH_KERNEL = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+
+# Answer-code -> letter table; the grouping kernel stays integer-only
+# and this single lookup replaces the old col % 5 elif cascade.
+_LETTERS = ('A', 'B', 'C', 'D', 'E')
+
+# detect_bubbles' cleanup kernel and 5-tap Gaussian, built once instead
+# of being re-derived on every call.
+_BUBBLE_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+_GAUSS_K5 = cv2.getGaussianKernel(5, 0)
+
+# With an OpenCL runtime present, wrapping the frame in cv2.UMat lets the
+# T-API run the per-pixel stages (cvtColor/blur/Canny/threshold/morphology)
+# on-device and download only for the CPU-side contour work.
+_USE_OPENCL = cv2.ocl.haveOpenCL()
+
+
+def detect_answers(img, debug=False):
+    """Run the full OMR pipeline on a decoded BGR image.
+
+    Returns a dict of question number -> answer letter. With debug=True,
+    returns (answers, overlay) where overlay is a BGR image with the
+    detected bubbles outlined.
+    """
+    # Work at a bounded resolution: bubble geometry is scale-invariant
+    # for these thresholds, and every downstream buffer shrinks with it.
+    h0, w0 = img.shape[:2]
+    scale = min(1.0, WORKING_RES / max(h0, w0))
+    if scale < 1.0:
+        img = cv2.resize(img, None, fx=scale, fy=scale,
+                         interpolation=cv2.INTER_AREA)
+
+    overlay = img.copy() if debug else None
+
+    # Single color transform: the HSV value plane doubles as the
+    # grayscale surrogate for deskew and as the threshold input.
+    hsv = cv2.cvtColor(cv2.UMat(img) if _USE_OPENCL else img, cv2.COLOR_BGR2HSV)
+    v = cv2.extractChannel(hsv, 2)
+
+    # --------- Auto Deskew ---------
+    blurred = cv2.GaussianBlur(v, (5, 5), 0)
+    edges = cv2.Canny(blurred, 50, 150)
+    coords = cv2.findNonZero(edges.get() if _USE_OPENCL else edges)
+
+    if coords is not None:
+        angle = cv2.minAreaRect(coords)[-1]
+        if angle < -45:
+            angle = -(90 + angle)
+        else:
+            angle = -angle
+        # Well-aligned scans are the common case — don't pay for a
+        # full-image warp over a fraction of a degree. Linear
+        # interpolation is plenty for the thresholding downstream.
+        if abs(angle) > DESKEW_MIN_ANGLE:
+            # Dimensions come from the ndarray — on the OpenCL path `v`
+            # is a cv2.UMat, which has no .shape.
+            (h, w) = img.shape[:2]
+            M = cv2.getRotationMatrix2D((w // 2, h // 2), angle, 1.0)
+            v = cv2.warpAffine(v, M, (w, h),
+                               flags=cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_REPLICATE)
+
+    # --------- Color-aware threshold ---------
+    thresh = cv2.adaptiveThreshold(
+        v, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+        cv2.THRESH_BINARY_INV, 15, 3
+    )
+
+    thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, _MORPH_KERNEL)
+    cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, _MORPH_KERNEL, dst=thresh)
+    if _USE_OPENCL:
+        thresh = thresh.get()
+
+    # --------- Bubble Detection ---------
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    bubbles = []
+    min_area = MIN_BUBBLE_AREA * scale * scale
+    max_area = MAX_BUBBLE_AREA * scale * scale
+    for c in contours:
+        area = cv2.contourArea(c)
+        if min_area < area < max_area:
+            x, y, w, h = cv2.boundingRect(c)
+            aspect_ratio = w / h
+            if 0.6 < aspect_ratio < 1.4:
+                bubbles.append((x, y, w, h))
+
+    if not bubbles:
+        return ({}, overlay) if debug else {}
+
+    # --------- Smart Row Clustering ---------
+    # Sort by y, split wherever the vertical gap exceeds the row gap,
+    # then order each row left-to-right — all in vectorized NumPy passes.
+    arr = np.array(bubbles, dtype=np.int32)
+    arr = arr[np.argsort(arr[:, 1])]
+    splits = np.where(np.diff(arr[:, 1]) > BUBBLE_ROW_GAP)[0] + 1
+    rows = [row[np.argsort(row[:, 0])] for row in np.split(arr, splits)]
+
+    # --------- Filled Bubble Detection ---------
+    # One integral image turns every per-bubble pixel count into
+    # four table lookups instead of an O(w*h) ROI scan.
+    ii = cv2.integral(thresh)
+    answers = {}
+    for qi, row in enumerate(rows, start=1):
+        best_fill = 0
+        best_opt = None
+        for oi, (x, y, w, h) in enumerate(row):
+            s = int(ii[y + h, x + w] - ii[y, x + w] - ii[y + h, x] + ii[y, x])
+            fill = s / (255.0 * w * h)
+
+            if debug:
+                color = (0, 255, 0) if fill > FILL_THRESHOLD else (0, 0, 255)
+                cv2.rectangle(overlay, (x, y), (x + w, y + h), color, 2)
+
+            if fill > best_fill and fill > FILL_THRESHOLD:
+                best_fill = fill
+                best_opt = chr(ord('A') + oi)
+
+        if best_opt:
+            answers[str(qi)] = best_opt
+
+    return (answers, overlay) if debug else answers
+
+
+# Explicit signature so the JIT compiles at import time, not inside the
+# first Streamlit request; nogil lets concurrent sheets overlap here.
+@njit(int8[:](int32[:, :], int64), cache=True, nogil=True)
+def _group_candidates(rects, col_thr):
+    """Grouping loop of detect_bubbles, compiled to machine code.
+
+    Takes the sorted (N,4) candidate rects and returns one answer code
+    0-4 (A-E) per candidate; the letter mapping stays at the Python
+    boundary.
+    """
+    codes = np.empty(rects.shape[0], dtype=np.int8)
+    for i in range(rects.shape[0]):
+        codes[i] = (rects[i, 0] // col_thr) % 5
+    return codes
+
+
+class OMRScratch:
+    """Reusable intermediate buffers for detect_bubbles.
+
+    Batch callers processing same-size pages pass one instance so the
+    gray/blur/thresh/cleaned planes are written in place instead of
+    being reallocated for every sheet.
+    """
+
+    def __init__(self, h, w):
+        self.shape = (h, w)
+        self.gray = np.empty((h, w), np.uint8)
+        self.blur = np.empty((h, w), np.uint8)
+        self.thresh = np.empty((h, w), np.uint8)
+        self.cleaned = np.empty((h, w), np.uint8)
+
+
+def detect_bubbles(image, debug=False, scratch=None):
     """
     Detect filled bubbles using contour analysis.
     Returns dictionary of question -> answer choice.
     """
     if isinstance(image, Image.Image):
-        img = np.array(image.convert('RGB'))
+        # Zero-copy view when the mode already matches; only exotic
+        # modes pay for the convert-and-copy.
+        img = np.asarray(image if image.mode in ('RGB', 'L') else image.convert('RGB'))
     else:
-        img = image.copy()
-
-    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-    thresh = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 11, 2)
+        # Nothing below mutates the input — every stage writes into its
+        # own (or scratch) buffer — so no defensive copy either.
+        img = image
 
-    # Morphological operations to clean up noise
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
-    cleaned = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
+    # Keep the per-pixel chain on-device via the T-API when an OpenCL
+    # runtime exists; download once for the labeling stage below. On the
+    # CPU path every stage writes into the (reusable) scratch planes.
+    if _USE_OPENCL:
+        src = cv2.UMat(img)
+        gray = src if img.ndim == 2 else cv2.cvtColor(src, cv2.COLOR_RGB2GRAY)
+        blurred = cv2.sepFilter2D(gray, -1, _GAUSS_K5, _GAUSS_K5)
+        thresh = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                       cv2.THRESH_BINARY_INV, 11, 2)
+        cleaned = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, _BUBBLE_KERNEL).get()
+    else:
+        h, w = img.shape[:2]
+        if scratch is None or scratch.shape != (h, w):
+            scratch = OMRScratch(h, w)
+        # Grayscale input (e.g. csGRAY-rendered PDF pages) skips the
+        # color conversion entirely.
+        if img.ndim == 2:
+            gray = img
+        else:
+            gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY, dst=scratch.gray)
+        blurred = cv2.sepFilter2D(gray, -1, _GAUSS_K5, _GAUSS_K5, dst=scratch.blur)
+        thresh = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                       cv2.THRESH_BINARY_INV, 11, 2, dst=scratch.thresh)
+        cleaned = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, _BUBBLE_KERNEL,
+                                   dst=scratch.cleaned)
 
-    contours, _ = cv2.findContours(cleaned, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    # One labeling pass returns every blob's bbox and pixel count as a
+    # single stats array — no per-contour Python/C boundary crossings.
+    n, _, stats, _ = cv2.connectedComponentsWithStats(
+        cleaned, connectivity=8, ltype=cv2.CV_32S
+    )
 
-    # Filter small contours
     min_area = 10
     max_area = 150
     candidates = []
-    for cnt in contours:
-        area = cv2.contourArea(cnt)
-        if min_area < area < max_area:
-            x, y, w, h = cv2.boundingRect(cnt)
-            aspect_ratio = w / h
-            if 0.8 < aspect_ratio < 1.2:
-                candidates.append((x, y, w, h))
+    if n > 1:  # label 0 is the background
+        rects = stats[1:, :4]
+        w = rects[:, 2]
+        h = rects[:, 3]
+        area = stats[1:, cv2.CC_STAT_AREA]
+        aspect_ratio = w / h
+        mask = ((area > min_area) & (area < max_area)
+                & (aspect_ratio > 0.8) & (aspect_ratio < 1.2))
+        candidates = [tuple(r) for r in rects[mask]]
 
     # Sort by row and column (top-to-bottom, left-to-right)
     candidates.sort(key=lambda c: (c[1], c[0]))
 
-    # Group into rows and columns
-    questions = {}
-    current_row = -1
-    current_col = -1
-    row_threshold = 50
+    # One answer per detected bubble — the old loop inserted an extra
+    # default 'A' whenever the row/column jumped, growing the dict twice
+    # per candidate. The compiled kernel emits exactly one code each and
+    # the dict is materialized once at the end.
     col_threshold = 50
 
-    for idx, (x, y, w, h) in enumerate(candidates):
-        row = y // row_threshold
-        col = x // col_threshold
-
-        if abs(row - current_row) > 1 or abs(col - current_col) > 1:
-            # New question
-            q_num = len(questions) + 1
-            questions[q_num] = 'A'  # Default to A
-
-        # Assign answer based on position
-        if col % 5 == 0:
-            questions[len(questions) + 1] = 'A'
-        elif col % 5 == 1:
-            questions[len(questions) + 1] = 'B'
-        elif col % 5 == 2:
-            questions[len(questions) + 1] = 'C'
-        elif col % 5 == 3:
-            questions[len(questions) + 1] = 'D'
-        elif col % 5 == 4:
-            questions[len(questions) + 1] = 'E'
-
-        current_row = row
-        current_col = col
+    questions = {}
+    if candidates:
+        codes = _group_candidates(np.array(candidates, dtype=np.int32),
+                                  col_threshold)
+        questions = {i + 1: _LETTERS[c] for i, c in enumerate(codes)}
 
     # Optional: show debug overlay
     if debug and len(candidates) > 0:
@@ -1,17 +1,98 @@
+import collections
+import concurrent.futures
+import os
+
+import cv2
 import fitz  # PyMuPDF
-from PIL import Image
-import io
+import numpy as np
+
+# Smallest median bubble width (px) that detect_bubbles resolves
+# reliably; below this the probe escalates to full resolution.
+_PROBE_MIN_BUBBLE_PX = 8
+_FULL_DPI = 150
+
+
+def _median_blob_width(page_arr):
+    """Median width of the near-square blobs on a rendered page."""
+    _, bw = cv2.threshold(page_arr, 0, 255,
+                          cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    n, _, stats, _ = cv2.connectedComponentsWithStats(bw, connectivity=8)
+    if n <= 1:
+        return 0.0
+    w = stats[1:, 2]
+    h = stats[1:, 3]
+    aspect_ratio = w / h
+    mask = (aspect_ratio > 0.8) & (aspect_ratio < 1.2)
+    if not mask.any():
+        return 0.0
+    return float(np.median(w[mask]))
+
+
+def extract_images_from_pdf(pdf_path, dpi=100):
+    """Render PDF pages one at a time, yielding NumPy arrays.
 
-def extract_images_from_pdf(pdf_path):
-    """Extract all images from PDF and return list of PIL Images."""
+    Pages rasterize at `dpi` by default; the first page doubles as a
+    probe, and if its bubbles come out too small for reliable detection
+    the remaining pages (and the probe) are re-rendered at 150 DPI.
+    Typical OMR sheets stay at the cheap resolution — render time scales
+    with pixel count.
+
+    Pages still rasterize concurrently, but only a small window of
+    rendered pages is ever held at once, so peak memory stays O(window)
+    instead of O(pages) — a 100-page PDF no longer needs several GB.
+    Arrays are handed to detect_bubbles as-is, skipping the PIL object
+    and its extra full-image conversion copy.
+    """
     doc = fitz.open(pdf_path)
-    images = []
 
-    for page in doc:
-        pix = page.get_pixmap(dpi=150)
-        img_data = pix.tobytes("png")
-        img = Image.open(io.BytesIO(img_data))
-        images.append(img)
+    def _pix_to_array(pix):
+        # View the raw sample buffer straight as an (H, W) array — no
+        # PNG round-trip and no PIL intermediate.
+        return np.frombuffer(pix.samples, dtype=np.uint8).reshape(
+            pix.height, pix.width
+        )
+
+    def _render(i, render_dpi):
+        # Each thread loads its own page handle; get_pixmap is C-level
+        # MuPDF work that releases the GIL, so pages render concurrently.
+        # Rendering straight to grayscale moves 1 byte/pixel instead of
+        # 3 — OMR never looks at color, and detect_bubbles takes the 2D
+        # plane as-is.
+        page = doc.load_page(i)
+        pix = page.get_pixmap(dpi=render_dpi, colorspace=fitz.csGRAY, alpha=False)
+        return _pix_to_array(pix)
+
+    try:
+        if doc.page_count == 0:
+            return
+
+        # The probe may render page 0 twice; rendering both DPIs from
+        # one cached DisplayList skips re-interpreting the page's
+        # content stream on the second pass.
+        probe_dl = doc.load_page(0).get_displaylist()
+
+        def _render_probe(render_dpi):
+            zoom = render_dpi / 72.0
+            pix = probe_dl.get_pixmap(matrix=fitz.Matrix(zoom, zoom),
+                                      colorspace=fitz.csGRAY, alpha=False)
+            return _pix_to_array(pix)
+
+        first = _render_probe(dpi)
+        bubble_width = _median_blob_width(first)
+        if 0 < bubble_width < _PROBE_MIN_BUBBLE_PX and dpi < _FULL_DPI:
+            dpi = _FULL_DPI
+            first = _render_probe(dpi)
+        yield first
 
-    doc.close()
-    return images
+        workers = os.cpu_count() or 1
+        window = 2 * workers
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+            pending = collections.deque()
+            for i in range(1, doc.page_count):
+                pending.append(ex.submit(_render, i, dpi))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        doc.close()
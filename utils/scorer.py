@@ -1,6 +1,31 @@
+import numpy as np
+
+
+def _answers_array(answers, questions):
+    """Encode answers for the given question order as a 'U1' array."""
+    return np.array([answers.get(q, '') for q in questions], dtype='U1')
+
+
 def calculate_score(key_answers, student_answers):
     total = len(key_answers)
     if total == 0:
         return 0
-    correct = sum(1 for q in key_answers if key_answers[q] == student_answers.get(q, None))
+    questions = sorted(key_answers)
+    key_arr = _answers_array(key_answers, questions)
+    stu_arr = _answers_array(student_answers, questions)
+    correct = int((stu_arr == key_arr).sum())
     return round((correct / total) * 100, 2)
+
+
+def calculate_scores_batch(key_answers, all_student_answers):
+    """Score many students against one key in a single vectorized compare."""
+    if not all_student_answers:
+        return []
+    total = len(key_answers)
+    if total == 0:
+        return [0] * len(all_student_answers)
+    questions = sorted(key_answers)
+    key_arr = _answers_array(key_answers, questions)
+    matrix = np.stack([_answers_array(s, questions) for s in all_student_answers])
+    scores = (matrix == key_arr).mean(axis=1) * 100
+    return [round(float(s), 2) for s in scores]